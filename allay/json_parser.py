@@ -1,6 +1,9 @@
 # Thanks fizzy <3 (https://github.com/vberlier/tokenstream/blob/main/examples/json.py)
+import json
 import re
 
+from tokenstream.error import InvalidSyntax
+
 ESCAPE_REGEX = re.compile(r"\\.")
 ESCAPE_SEQUENCES = {
     r"\n": "\n",
@@ -9,16 +12,89 @@ ESCAPE_SEQUENCES = {
 }
 
 
+def unescape(match):
+    return ESCAPE_SEQUENCES[match[0]]
+
+
 def unquote_string(token):
-    return ESCAPE_REGEX.sub(lambda match: ESCAPE_SEQUENCES[match[0]], token.value[1:-1])
+    value = token.value[1:-1]
+
+    # Most strings don't contain any escapes, so skip the regex entirely for those
+    if "\\" not in value:
+        return value
+    return ESCAPE_REGEX.sub(unescape, value)
+
+
+# How deeply brackets, scopes and JSON values can be nested, keeps the remaining recursion well clear of Python's recursion limit
+MAX_NESTING_DEPTH = 128
+
+# Strings are matched whole so that brackets inside of them are skipped
+JSON_DELIMITER_REGEX = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+OPENING_DELIMITERS = frozenset("{[")
+CLOSING_DELIMITERS = frozenset("}]")
+
+
+def reject_constant(name):
+    # NaN and Infinity aren't valid JSON, so they shouldn't end up in the output
+    raise ValueError(f"Invalid JSON constant {name}")
+
+
+def scan_json_span(source, start):
+    # Returns the index right after the object or array starting at ``start``, or -1 if there isn't a balanced one (or it's nested too deeply for the json module)
+    if source[start : start + 1] not in OPENING_DELIMITERS:
+        return -1
+
+    depth = 0
+    for match in JSON_DELIMITER_REGEX.finditer(source, start):
+        delimiter = match[0]
+        if delimiter in OPENING_DELIMITERS:
+            depth += 1
+            if depth > MAX_NESTING_DEPTH:
+                return -1
+        elif delimiter in CLOSING_DELIMITERS:
+            depth -= 1
+            if depth == 0:
+                return match.end()
+
+    return -1
 
 
 def parse_json(stream):
+    # Let the json module (implemented in C) handle the whole value when it can, and fall back to parsing it token by token otherwise
+    if token := stream.peek():
+        start = token.location.pos
+        end = scan_json_span(stream.source, start)
+
+        if end != -1:
+            try:
+                value = json.loads(
+                    stream.source[start:end], parse_constant=reject_constant
+                )
+            except ValueError:
+                pass
+            else:
+                # Move the stream past the value as if it had been tokenized
+                stream.crop()
+                if whitespace := stream.source[stream.current.end_location.pos : start]:
+                    stream.emit_token("whitespace", whitespace)
+                stream.emit_token("json", stream.source[start:end])
+                return value
+
+    return parse_json_tokens(stream)
+
+
+def parse_json_tokens(stream, depth=0):
+    # Fallback for values the json module rejects, like objects with trailing commas
+    if depth >= MAX_NESTING_DEPTH:
+        raise stream.emit_error(
+            InvalidSyntax(f"Exceeded the maximum nesting depth of {MAX_NESTING_DEPTH}")
+        )
+
     with stream.syntax(
         curly=r"\{|\}",
         bracket=r"\[|\]",
-        string=r'"(?:\\.|[^"\\])*"',
-        number=r"\d*\.?\d+",
+        string=r'"[^"\\]*(?:\\.[^"\\]*)*"',
+        number=r"-?\d*\.?\d+(?:[eE][+-]?\d+)?",
         colon=r":",
         comma=r",",
         boolean=r"true|false",
@@ -32,7 +108,7 @@ def parse_json(stream):
 
             for key in stream.collect("string"):
                 stream.expect("colon")
-                result[unquote_string(key)] = parse_json(stream)
+                result[unquote_string(key)] = parse_json_tokens(stream, depth + 1)
 
                 if not stream.get("comma"):
                     break
@@ -44,10 +120,10 @@ def parse_json(stream):
             if stream.get(("bracket", "]")):
                 return []
 
-            result = [parse_json(stream)]
+            result = [parse_json_tokens(stream, depth + 1)]
 
             for _ in stream.collect("comma"):
-                result.append(parse_json(stream))
+                result.append(parse_json_tokens(stream, depth + 1))
 
             stream.expect(("bracket", "]"))
             return result
@@ -56,7 +132,8 @@ def parse_json(stream):
             return unquote_string(string)
 
         elif number:
-            return float(number.value) if "." in number.value else int(number.value)
+            value = number.value
+            return float(value) if "." in value or "e" in value.lower() else int(value)
 
         elif boolean:
-            return bool(boolean.value)
+            return boolean.value == "true"
@@ -1,11 +1,122 @@
 import json
+import os
+import re
+import sys
 from contextlib import contextmanager
-from typing import Union
-
-from tokenstream import TokenStream
-from tokenstream.error import InvalidSyntax
-
-from allay.json_parser import parse_json
+from typing import Optional, Union
+
+from tokenstream import Token, TokenStream
+from tokenstream.error import InvalidSyntax, UnexpectedToken
+
+from allay.json_parser import MAX_NESTING_DEPTH, parse_json, scan_json_span
+
+# Double-quoted strings, escaped characters included
+STRING_PATTERN = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+# Selector argument text, with quoted values matched whole so brackets inside of them are skipped
+SELECTOR_ARGUMENTS = rf'(?:[^\[\]"]|{STRING_PATTERN})*'
+
+# Token rules are kept at module level so the same mappings are reused on every (recursive) parse call
+PRIMARY_SYNTAX = {
+    # Text is the most common token, so it's tried first. Equals and arrows are only expected where text is turned off
+    "text": r"[^\[\]\{\}<>\\]+",
+    # Symbols
+    "escape": r"\\.",
+    "sqrbr": r"\[|\]",
+    "brace": r"\{|\}",
+    "scope": r"<|>",
+    "equals": r"=",
+    "arrow": r" ?[-=]> ?",
+    # Types
+    "hex_code": r"#[0-9a-fA-F]{6}",
+    # The part before the first dot excludes dots, so there is only one way to split a match
+    "url": r"https?://[^(),\s.]+\.[^(),\s]+",
+    "integer": r"[\d]+",
+    # Allows one level of nested brackets in arguments, like nbt={Items:[...]}, and brackets inside quoted values. Deeper arguments are scanned for in code.
+    "selector": rf"@[parse](?:\[{SELECTOR_ARGUMENTS}(?:\[{SELECTOR_ARGUMENTS}\]{SELECTOR_ARGUMENTS})*\])?",
+    "string": STRING_PATTERN,
+    # Bare words, classified through KEYWORDS
+    "ident": r"[A-Za-z_]\w*",
+}
+
+# Maps every keyword to the token type the parser expects it as
+KEYWORDS = {
+    keyword: keyword_type
+    for keyword_type, keywords in {
+        # Types
+        "color": "black dark_blue dark_green dark_aqua dark_red dark_purple gold gray dark_gray blue green aqua red light_purple yellow white reset",
+        "keybind": "advancements attack back chat command drop forward fullscreen hotbar inventory jump left loadToolbarActivator pickItem playerlist right saveToolbarActivator screenshot smoothCamera sneak socialInteractions spectatorOutlines sprint swapOffhand togglePerspective use",
+        "boolean": "true false",
+        # Keywords sorted by type
+        "kw_json": "hover_item",
+        "kw_scope": "hover_text",
+        "kw_color": "color",
+        "kw_link": "link",
+        "kw_string": "copy suggest run insertion font",
+        "kw_bool": "bold italic obfuscated strikethrough underlined",
+        "kw_integer": "page",
+        "kw_standalone": "block entity storage translate score nbt separator interpret sep key with",
+    }.items()
+    for keyword in keywords.split()
+}
+
+PAREN_SYNTAX = {"paren": r"\(|\)"}
+PARENT_SYNTAX = {"paren": r"\(|\)", "null": r"null|NULL"}
+DEFINITION_SYNTAX = {
+    "pattern": r"@\w+",
+    "template": r"\$\w+",
+    "parent": r"PARENT",
+    "equals": r"=",
+    "paren": r"\(|\)",
+    "brace": r"{|}",
+}
+# Covers both standalone elements and template references, so a standalone block only enters one syntax context
+STANDALONE_SYNTAX = {"text": None, "comma": r",", "template": r"\$\w+"}
+MODIFIER_SYNTAX = {"text": None, "comma": r",", "pattern": r"@\w+"}
+
+# Escape sequences that are unescaped in text, any other escape sequence is kept as-is
+ESCAPE_SEQUENCES = {"\\" + character: character for character in "bfnrt\\[](){}<>"}
+
+CLICK_ACTIONS = {
+    "copy": "copy_to_clipboard",
+    "suggest": "suggest_command",
+    "run": "run_command",
+}
+
+# Escaped quotes and backslashes in strings, other escape sequences are kept as-is
+STRING_ESCAPE_REGEX = re.compile(r'\\(["\\])')
+
+TEMPLATE_ARG_REGEX = re.compile(r"%(\d+)")
+
+
+def substitute_template_args(node, args: list):
+    # Builds a fresh copy of a template, replacing %0, %1, ... in every string with the matching argument
+    if isinstance(node, str):
+
+        def replace(match: re.Match) -> str:
+            # Placeholders without a matching argument are left untouched
+            index = int(match[1])
+            return args[index] if index < len(args) else match[0]
+
+        return TEMPLATE_ARG_REGEX.sub(replace, node)
+    elif isinstance(node, dict):
+        return {
+            key: substitute_template_args(value, args) for key, value in node.items()
+        }
+    elif isinstance(node, list):
+        return [substitute_template_args(item, args) for item in node]
+    return node
+
+
+def get_line(source: str, lineno: int) -> str:
+    # Finds a single (1-indexed) line without splitting the whole source
+    start = 0
+    for _ in range(lineno - 1):
+        start = source.find("\n", start) + 1
+        if not start:
+            return ""
+
+    end = source.find("\n", start)
+    return source[start:] if end == -1 else source[start:end]
 
 
 class DefinitionAlreadyExists(Exception):
@@ -20,13 +131,31 @@ class Parser:
         indent (int, optional): Indentation level. Ignored if ``json_dump`` is False. Defaults to None.
         json_dump (bool, optional): Whether to dump the output as JSON in a string. Defaults to None.
         definition_delimeter (str, optional): The delimeter that should separate the definitions from the text. Defaults to "#ALLAYDEFS\n".
+        cache_size (int, optional): How many dumped results to keep for text that is parsed again. Set to 0 to disable caching. Defaults to 1024.
     """
 
+    __slots__ = (
+        "indent",
+        "json_dump",
+        "definition_delimeter",
+        "patterns",
+        "templates",
+        "parent",
+        "scope_depth",
+        "nesting_depth",
+        "definitions",
+        "definitions_parent",
+        "cache",
+        "cache_size",
+        "uses_definitions",
+    )
+
     def __init__(
         self,
         indent: int = None,
         json_dump: bool = None,
         definition_delimeter: str = "#ALLAYDEFS\n",
+        cache_size: int = 1024,
     ) -> None:
         # Set default parser options
         self.indent = indent
@@ -38,6 +167,17 @@ class Parser:
         self.patterns = {}
         self.templates = {}
         self.parent = ""
+        self.scope_depth = 0
+        self.nesting_depth = 0
+
+        # The last definitions block that was parsed, and the parent it set (None if it has no PARENT line)
+        self.definitions = None
+        self.definitions_parent = None
+
+        self.cache = {}
+        self.cache_size = cache_size
+        # Whether the current parse referenced a pattern or template
+        self.uses_definitions = False
 
     def parse(
         self, text: str, indent: int = None, json_dump: bool = None
@@ -56,41 +196,114 @@ class Parser:
         Returns:
             Union[str, dict]: The text-component
         """
+        # Check if it's a file. Multi-line or very long text can't be a path, so it skips the filesystem check entirely
+        if len(text) < 4096 and "\n" not in text and os.path.isfile(text):
+            return self.parse_file(text, indent, json_dump)
+        return self.parse_string(text, indent, json_dump)
+
+    def parse_string(
+        self, text: str, indent: int = None, json_dump: bool = None
+    ) -> Union[str, dict]:
+        """
+        parse_string - Converts a string into a text-component using the Allay format. Unlike ``parse``, the text is never treated as a file path.
+
+        Args:
+            text (str): The text to parse
+            indent (int, optional): Indentation level. Ignored if ``json_dump`` is False. Defaults to None.
+            json_dump (bool, optional): Whether to dump the output as JSON in a string. Defaults to None.
+
+        Raises:
+            InvalidSyntax: The syntax is invalid
+
+        Returns:
+            Union[str, dict]: The text-component
+        """
+        return self.parse_source(text, '"src"', indent, json_dump)
+
+    def parse_file(
+        self, path: str, indent: int = None, json_dump: bool = None
+    ) -> Union[str, dict]:
+        """
+        parse_file - Converts the contents of a file into a text-component using the Allay format
+
+        Args:
+            path (str): The path of the file to parse
+            indent (int, optional): Indentation level. Ignored if ``json_dump`` is False. Defaults to None.
+            json_dump (bool, optional): Whether to dump the output as JSON in a string. Defaults to None.
+
+        Raises:
+            InvalidSyntax: The syntax is invalid
+
+        Returns:
+            Union[str, dict]: The text-component
+        """
+        # Unbuffered binary read, so the file is fetched in one go and decoded once
+        with open(path, "rb", buffering=0) as infile:
+            text = infile.read().decode("utf-8")
+
+        # Keep the universal newlines behaviour of text mode
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+        return self.parse_source(text, f'File "{path}"', indent, json_dump)
+
+    def parse_source(
+        self, text: str, file: str, indent: int = None, json_dump: bool = None
+    ) -> Union[str, dict]:
         # Grab defaults (if neither defaults nor function-level config is set, then it should remain None and work fine)
-        if not indent and self.indent:
+        if indent is None:
             indent = self.indent
 
         if json_dump is None:
             json_dump = self.json_dump if self.json_dump is not None else True
 
-        # Check if it's a file, and if it is, use the file contents as the input
-        try:
-            file = f'File "{text}"'  # File path
-            with open(text, "r") as infile:
-                text = infile.read()
-        except OSError as error:
-            file = '"src"'
+        # Text without a definitions block or a parent always gives the same output, unless it uses a pattern or template, which can be changed directly through the patterns and templates dicts. Lists aren't cached because the caller could modify them.
+        cache_key = None
+        if (
+            self.cache_size
+            and json_dump
+            and not self.parent
+            and self.definition_delimeter not in text
+        ):
+            cache_key = (text, indent)
+            if (cached := self.cache.get(cache_key)) is not None:
+                return cached
+
+        # Bound up front since errors in the definitions are raised before the text has a stream
+        stream = None
+        self.uses_definitions = False
 
         # Print errors but with pizzaz
         try:
             stream = TokenStream(self.pre_process(text))
             output = self.internal_parse(stream)
 
-            self.parent = ""
-
             if json_dump:
-                return json.dumps(output, indent=indent)
+                output = json.dumps(output, indent=indent)
+
+                if cache_key is not None and not self.uses_definitions:
+                    # Drop the oldest entry once the cache is full
+                    if len(self.cache) >= self.cache_size:
+                        del self.cache[next(iter(self.cache))]
+                    self.cache[cache_key] = output
+
             return output
 
         except InvalidSyntax as error:
             error_line = error.location.lineno
             error_column = error.location.colno
+            # Definitions are parsed from the start of the stripped input, so their positions line up with it
+            source = stream.source if stream else text.lstrip()
             raise InvalidSyntax(
-                f"Fatal error:\n\t{file}, line {error_line}\n\t\t{stream.source.split(chr(10))[error_line - 1]}\n\t\t{' ' * (error_column - 1)}^\nInvalidSyntax: {str(error)}".expandtabs(
+                f"Fatal error:\n\t{file}, line {error_line}\n\t\t{get_line(source, error_line)}\n\t\t{' ' * (error_column - 1)}^\nInvalidSyntax: {str(error)}".expandtabs(
                     2
                 )
             )
 
+        finally:
+            # The parent only applies to this parse, even if it failed, so it can't leak into the next one when a parser is shared (like in the beet plugin)
+            self.parent = ""
+
     def set_defaults(self, indent: int = None, json_dump: bool = None) -> None:
         """
         set_defaults - Sets the default values for the parse function
@@ -99,10 +312,10 @@ class Parser:
             indent (int, optional): Indentation level. Ignored if ``json_dump`` is False. Defaults to None.
             json_dump (bool, optional): Whether to dump the output as JSON in a string. Defaults to None.
         """
-        if indent:
+        if indent is not None:
             self.indent = indent
 
-        if json_dump:
+        if json_dump is not None:
             self.json_dump = json_dump
 
     def set_parent(
@@ -111,7 +324,7 @@ class Parser:
         if auto_generate_stream and not isinstance(stream, TokenStream):
             stream = TokenStream(stream)
 
-        with stream.syntax(paren=r"\(|\)", null=r"null|NULL"):
+        with stream.syntax(**PARENT_SYNTAX):
             if stream.get(("paren", "(")):
                 with self.primary_syntax_definitions(stream):
                     contents = self.parse_modifiers(stream)
@@ -130,51 +343,63 @@ class Parser:
 
     def pre_process(self, text: str) -> str:
         # Separate the special components (patterns and templates)
-        defs_end_index = text.find(self.definition_delimeter)
+        definitions, delimeter, body = text.partition(self.definition_delimeter)
 
         # The split token was found
-        if defs_end_index != -1:
-            stream = TokenStream(text[:defs_end_index].strip())
-            self.parse_definitions(stream)
+        if delimeter:
+            definitions = definitions.strip()
+
+            # Re-parsing the same document (e.g. when only its text changed) reuses the definitions it already added
+            if definitions == self.definitions:
+                if self.definitions_parent is not None:
+                    self.parent = self.definitions_parent
+            else:
+                self.definitions_parent = self.parse_definitions(
+                    TokenStream(definitions)
+                )
+                self.definitions = definitions
 
-            # Remove #ALLAYDEFS (and the following newline) from the text
-            text = text[defs_end_index + len(self.definition_delimeter) :]
+            # Everything after #ALLAYDEFS (and the following newline) is the text
+            text = body
 
         return text.strip()
 
+    def get_raw_string(self, stream: TokenStream) -> str:
+        # Quotes are stripped but escapes are kept as-is
+        return stream.expect("string").value[1:-1]
+
     def get_string(self, stream: Union[str, TokenStream]) -> str:
-        return stream.expect("string").value[1:-1].replace('\\"', '"')
+        value = self.get_raw_string(stream)
+        # Most strings don't contain any escapes, so skip the regex for those
+        if "\\" not in value:
+            return value
+        return STRING_ESCAPE_REGEX.sub(r"\1", value)
+
+    def keyword_type(self, token: Token) -> Optional[str]:
+        # Bare words are classified through KEYWORDS, other tokens keep their own type
+        return KEYWORDS.get(token.value) if token.match("ident") else token.type
+
+    def expect_keyword(self, stream: TokenStream, *patterns: str):
+        # Works like stream.expect, but bare words are matched by their type in KEYWORDS
+        token = stream.expect()
+        token_type = self.keyword_type(token)
+
+        if token_type not in patterns:
+            raise token.emit_error(UnexpectedToken(token, patterns))
+
+        if len(patterns) == 1:
+            return token
+        return tuple(token if pattern == token_type else None for pattern in patterns)
+
+    def get_keyword(self, stream: TokenStream, pattern: str) -> Optional[Token]:
+        token = stream.peek()
+        if token and token.match("ident") and KEYWORDS.get(token.value) == pattern:
+            return stream.expect()
+        return None
 
     @contextmanager
     def primary_syntax_definitions(self, stream: TokenStream):
-        with stream.syntax(
-            # Symbols
-            escape=r"\\.",
-            sqrbr=r"\[|\]",
-            brace=r"\{|\}",
-            scope=r"<|>",
-            equals=r"=",
-            text=r"[^\[\]\{\}<>\\]+",
-            arrow=r" ?[-=]> ?",
-            # Types
-            hex_code=r"#[0-9a-fA-F]{6}",
-            url=r"http(s)?:\/\/[^(),]+\.[^(),]+",
-            integer=r"[\d]+",
-            color=r"black|dark_blue|dark_green|dark_aqua|dark_red|dark_purple|gold|gray|dark_gray|blue|green|aqua|red|light_purple|yellow|white|reset",
-            keybind=r"advancements|attack|back|chat|command|drop|forward|fullscreen|hotbar|inventory|jump|left|loadToolbarActivator|pickItem|playerlist|right|saveToolbarActivator|screenshot|smoothCamera|sneak|socialInteractions|spectatorOutlines|sprint|swapOffhand|togglePerspective|use",
-            selector=r"@[parse](\[.*\])?",
-            boolean=r"true|false",
-            string=r'"(?:\\.|[^"\\])*"',
-            # Keywords sorted by type
-            kw_json=r"hover_item",
-            kw_scope=r"hover_text",
-            kw_color=r"color",
-            kw_link=r"link",
-            kw_string=r"copy|suggest|run|insertion|font",
-            kw_bool=r"bold|italic|obfuscated|strikethrough|underlined",
-            kw_integer=r"page",
-            kw_standalone=r"block|entity|storage|selector|translate|score|nbt|separator|interpret|sep|key|with",
-        ):
+        with stream.syntax(**PRIMARY_SYNTAX):
             yield
 
     def add_definition(
@@ -187,7 +412,10 @@ class Parser:
         obj = self.patterns if type == "pattern" else self.templates
 
         name_prefix = "@" if type == "pattern" else "$"
-        internal_name = name if name.startswith(name_prefix) else name_prefix + name
+        # Interned since the name is used as a lookup key every time the definition is referenced
+        internal_name = sys.intern(
+            name if name.startswith(name_prefix) else name_prefix + name
+        )
 
         if internal_name in obj:
             raise DefinitionAlreadyExists(
@@ -221,7 +449,7 @@ class Parser:
         )
 
         # Despite being defined in the outer scope, this token needs to be defined in here also because parenthesis are required when using add_pattern directly. Without this token definition, calling this function directly will result in expecting a parenthesis and fail.
-        with stream.syntax(paren=r"\(|\)"):
+        with stream.syntax(**PAREN_SYNTAX):
             # Parenthesis should be required in both add_pattern and in-text usage
             stream.expect(("paren", "("))
             with self.primary_syntax_definitions(stream):
@@ -259,17 +487,13 @@ class Parser:
 
         return contents
 
-    def parse_definitions(self, stream: TokenStream) -> None:
-        with stream.syntax(
-            pattern=r"@\w+",
-            template=r"\$\w+",
-            parent=r"PARENT",
-            equals=r"=",
-            paren=r"\(|\)",
-            brace=r"{|}",
-        ), stream.intercept("newline"):
+    def parse_definitions(self, stream: TokenStream) -> Union[dict, str, None]:
+        # Returns the parent set by the definitions, or None if they don't set one
+        parent_contents = None
 
-            try:
+        with stream.syntax(**DEFINITION_SYNTAX), stream.intercept("newline"):
+            # The definitions are stripped beforehand, so the loop ends on the last definition instead of on a failed expect
+            while True:
                 pattern, template, parent = stream.expect(
                     "pattern", "template", "parent"
                 )
@@ -287,148 +511,202 @@ class Parser:
                     stream.expect(("brace", "}"))
 
                 elif parent:
-                    self.set_parent(stream, auto_generate_stream=False)
+                    parent_contents = self.set_parent(
+                        stream, auto_generate_stream=False
+                    )
 
-                if stream.get("newline"):
-                    # Handle new lines in-between arguments
-                    while stream.get("newline"):
-                        continue
+                if not stream.get("newline"):
+                    break
 
-                    self.parse_definitions(stream)
+                # Handle new lines in-between arguments
+                while stream.get("newline"):
+                    continue
 
-            except InvalidSyntax as error:
-                # Check if there's no data left to parse. This handles there being extra newlines between any arguments and the #ALLAYDEFS keyword. If there's still data left, then there's a syntax error.
-                if stream.source[stream.current.location.pos :].strip():
-                    raise error
+        return parent_contents
 
     def internal_parse(self, stream: TokenStream) -> list:
-        output = []
-
-        with self.primary_syntax_definitions(stream):
-            for sqrbr, brace, escape, text in stream.collect(
-                ("sqrbr", "["), ("brace", "{"), "escape", "text"
-            ):
-                if escape:
-                    if escape.value[1] in {
-                        "b",
-                        "f",
-                        "n",
-                        "r",
-                        "t",
-                        "\\",
-                        "[",
-                        "]",
-                        "(",
-                        ")",
-                        "{",
-                        "}",
-                        "<",
-                        ">",
-                    }:
-                        output.append(escape.value[1])
+        output = [self.parent or ""]
+        # Text and escapes are collected and joined once whenever a component ends, instead of being concatenated one by one
+        text_buffer = []
+        # The outputs that the currently open [modified] blocks will be added to. Brackets are tracked here instead of recursing for each one.
+        open_blocks = []
+
+        with self.enter_nesting(stream), self.primary_syntax_definitions(stream):
+            # Dispatches on the type of each token directly, ordered by how often they show up
+            while token := stream.peek():
+                token_type = token.type
+
+                if token_type == "text":
+                    next(stream)
+                    text_buffer.append(token.value)
+
+                elif token_type == "escape":
+                    next(stream)
+                    text_buffer.append(ESCAPE_SEQUENCES.get(token.value, token.value))
+
+                elif token.match(("sqrbr", "["), ("brace", "{")) or (
+                    open_blocks and token.match(("sqrbr", "]"))
+                ):
+                    next(stream)
+                    if text_buffer:
+                        output.append({"text": "".join(text_buffer)})
+                        text_buffer.clear()
+
+                    if token.value == "[":
+                        self.check_nesting_depth(
+                            stream, self.nesting_depth + len(open_blocks)
+                        )
+                        open_blocks.append(output)
+                        output = [""]
+
+                    elif token.value == "]":
+                        modified_text = output
+                        output = open_blocks.pop()
+
+                        with stream.syntax(**PAREN_SYNTAX):
+                            stream.expect(("paren", "("))
+                            modifier_contents = self.parse_modifiers(stream)
+                            stream.expect(("paren", ")"))
+
+                        # Only the text of the first component is kept
+                        modified_block = {"text": modified_text[1]["text"]}
+                        modified_block.update(modifier_contents)
+                        output.append(modified_block)
+
                     else:
-                        output.append(escape.value)
-
-                elif sqrbr:
-                    modified_text = self.internal_parse(stream)
-                    stream.expect(("sqrbr", "]"))
-
-                    with stream.syntax(paren=r"\(|\)"):
-                        stream.expect(("paren", "("))
-                        modifier_contents = self.parse_modifiers(stream)
-                        stream.expect(("paren", ")"))
-
-                    output.append(
-                        {
-                            "modified_text": modified_text,
-                            "modifier_contents": modifier_contents,
-                        }
-                    )
+                        # Standalones and templates are already in their final form
+                        output.append(self.parse_standalone(stream))
+
+                else:
+                    break
 
-                elif brace:
-                    q = self.parse_standalone(stream)
-                    output.append(q)
+            # Raises the same error as an unclosed bracket always did
+            if open_blocks:
+                stream.expect(("sqrbr", "]"))
 
-                elif text:
-                    output.append(text.value)
+            if text_buffer:
+                output.append({"text": "".join(text_buffer)})
 
-            output = self.clean_ast(output)
-            output = self.convert_ast_to_json(output)
             return output
 
+    def check_nesting_depth(self, stream: TokenStream, depth: int) -> None:
+        # Fails with a syntax error on absurdly nested input
+        if depth >= MAX_NESTING_DEPTH:
+            raise stream.emit_error(
+                InvalidSyntax(
+                    f"Exceeded the maximum nesting depth of {MAX_NESTING_DEPTH}"
+                )
+            )
+
+    @contextmanager
+    def enter_nesting(self, stream: TokenStream):
+        self.check_nesting_depth(stream, self.nesting_depth)
+
+        self.nesting_depth += 1
+        try:
+            yield
+        finally:
+            self.nesting_depth -= 1
+
+    @contextmanager
+    def enter_scope(self):
+        # Click and hover modifiers are rejected while inside of a scope block
+        self.scope_depth += 1
+        try:
+            yield
+        finally:
+            self.scope_depth -= 1
+
     def error_if_scope(self, stream: TokenStream) -> None:
-        if stream.data.get("scoped"):
+        if self.scope_depth:
             raise InvalidSyntax("Unexpected scope")
 
+    def parse_string_argument(self, stream: TokenStream) -> str:
+        stream.expect("equals")
+        return self.get_string(stream)
+
+    def parse_raw_string_argument(self, stream: TokenStream) -> str:
+        stream.expect("equals")
+        return self.get_raw_string(stream)
+
+    def parse_keybind_argument(self, stream: TokenStream) -> str:
+        stream.expect("equals")
+        return "key." + self.expect_keyword(stream, "keybind").value
+
+    def parse_json_argument(self, stream: TokenStream) -> Union[dict, list]:
+        stream.expect("equals")
+        return parse_json(stream)
+
+    def parse_score_argument(self, stream: TokenStream) -> dict:
+        stream.expect("equals")
+        player_name = self.get_string(stream)
+        stream.expect("arrow")
+        objective_name = self.get_string(stream)
+        return {"name": player_name, "objective": objective_name}
+
+    def parse_boolean_argument(self, stream: TokenStream) -> bool:
+        # The value is optional, the keyword on its own means true
+        if stream.get("equals"):
+            return self.expect_keyword(stream, "boolean").value == "true"
+        return True
+
+    # Standalone keyword -> (output key, argument parser)
+    STANDALONE_ARGUMENTS = {
+        "sep": ("separator", parse_string_argument),
+        "separator": ("separator", parse_string_argument),
+        "key": ("keybind", parse_keybind_argument),
+        "translate": ("translate", parse_string_argument),
+        "with": ("with", parse_json_argument),
+        "nbt": ("nbt", parse_string_argument),
+        "block": ("block", parse_raw_string_argument),
+        "entity": ("entity", parse_raw_string_argument),
+        "storage": ("storage", parse_raw_string_argument),
+        "score": ("score", parse_score_argument),
+        "interpret": ("interpret", parse_boolean_argument),
+    }
+
     def parse_non_template_standalone(self, stream: TokenStream) -> dict:
+        # Expects to be called within STANDALONE_SYNTAX
         standalone_contents = {}
 
-        with stream.syntax(text=None, comma=r","):
+        while True:
             selector = stream.get("selector")
-            kw_standalone = stream.get("kw_standalone")
+            kw_standalone = self.get_keyword(stream, "kw_standalone")
 
             if selector:
-                standalone_contents["selector"] = selector.value
+                standalone_contents["selector"] = self.get_selector(stream, selector)
 
             elif kw_standalone:
-                if kw_standalone.value in {"sep", "separator"}:
-                    stream.expect("equals")
-                    standalone_contents["separator"] = self.get_string(stream)
-
-                elif kw_standalone.value == "key":
-                    stream.expect("equals")
-                    standalone_contents["keybind"] = (
-                        "key." + stream.expect("keybind").value
-                    )
-
-                elif kw_standalone.value == "translate":
-                    stream.expect("equals")
-                    standalone_contents["translate"] = self.get_string(stream)
-
-                elif kw_standalone.value == "with":
-                    stream.expect("equals")
-                    standalone_contents["with"] = parse_json(stream)
-
-                elif kw_standalone.value == "nbt":
-                    stream.expect("equals")
-                    standalone_contents["nbt"] = self.get_string(stream)
-
-                elif kw_standalone.value in {"block", "entity", "storage"}:
-                    stream.expect("equals")
-                    standalone_contents[kw_standalone.value] = stream.expect(
-                        "string"
-                    ).value[1:-1]
-
-                elif kw_standalone.value == "score":
-                    stream.expect("equals")
-                    player_name = self.get_string(stream)
-                    stream.expect("arrow")
-                    objective_name = self.get_string(stream)
-                    standalone_contents["score"] = {
-                        "name": player_name,
-                        "objective": objective_name,
-                    }
-
-                elif kw_standalone.value == "interpret":
-                    if stream.get("equals"):
-                        boolean_value = stream.expect("boolean").value
-                    else:
-                        boolean_value = "true"
-
-                    standalone_contents["interpret"] = boolean_value == "true"
+                key, parse_argument = self.STANDALONE_ARGUMENTS[kw_standalone.value]
+                standalone_contents[key] = parse_argument(self, stream)
 
             else:
                 raise InvalidSyntax("Unknown standalone element input")
 
-        if stream.get("comma"):
-            standalone_contents |= self.parse_non_template_standalone(stream)
+            if not stream.get("comma"):
+                break
 
         return standalone_contents
 
+    def get_selector(self, stream: TokenStream, selector: Token) -> str:
+        # Arguments nested deeper than the selector rule allows are left out of the token, so they're found by scanning for the matching bracket
+        start = selector.end_location.pos
+        if selector.value.endswith("]") or stream.source[start : start + 1] != "[":
+            return selector.value
+
+        end = scan_json_span(stream.source, start)
+        if end == -1 or stream.source[end - 1] != "]":
+            return selector.value
+
+        # Move the stream past the arguments as if they had been tokenized
+        stream.crop()
+        arguments = stream.emit_token("selector_arguments", stream.source[start:end])
+        return selector.value + arguments.value
+
     def parse_standalone(self, stream: TokenStream) -> dict:
         standalone_contents = {}
 
-        with stream.syntax(text=None, comma=r",", template=r"\$\w+"):
+        with stream.syntax(**STANDALONE_SYNTAX):
             if token := stream.peek():
                 if token.match("template"):
                     template = stream.expect("template")
@@ -437,211 +715,182 @@ class Parser:
                         raise InvalidSyntax(f"Unknown template '{q}'")
 
                     args = self.parse_template_args(stream)
+                    self.uses_definitions = True
 
-                    # Turn the template into a string so we can use replace on it
-                    template_value = json.dumps(self.templates[q])
-
-                    # Replace all the tokens
-                    for index, arg in enumerate(args):
-                        template_value = template_value.replace(f"%{index}", arg)
-
-                    # Convert it back into a dictionary
-                    standalone_contents = json.loads(template_value)
+                    standalone_contents = substitute_template_args(
+                        self.templates[q], args
+                    )
 
                 else:
                     standalone_contents = self.parse_non_template_standalone(stream)
 
             stream.expect(("brace", "}"))
 
-            with stream.syntax(paren=r"\(|\)"):
+            with stream.syntax(**PAREN_SYNTAX):
                 if stream.get(("paren", "(")):
                     modifier_contents = self.parse_modifiers(stream)
                     stream.expect(("paren", ")"))
 
-                    try:
-                        standalone_contents = standalone_contents | modifier_contents
-                    except TypeError:
+                    # Templates are lists, so they can't be merged with modifiers
+                    if not isinstance(standalone_contents, dict):
                         raise InvalidSyntax("Modifiers are not supported on templates")
+                    standalone_contents.update(modifier_contents)
 
         return standalone_contents
 
     def parse_template_args(self, stream: TokenStream) -> list:
         args = []
-        if stream.get("comma"):
-            # 1:-1 to remove quotes
-            args.append(self.get_string(stream))
-            # Add the previous argument to the list
-            args.extend(self.parse_template_args(stream))
+        while stream.get("comma"):
+            # Arguments are decoded as JSON strings, so escapes like \n, \t and \u00e9 work. Raw newlines in the quotes are allowed too.
+            string = stream.expect("string")
+            try:
+                args.append(json.loads(string.value, strict=False))
+            except ValueError:
+                raise string.emit_error(
+                    InvalidSyntax(
+                        f"Invalid escape sequence in template argument {string.value}"
+                    )
+                )
 
         return args
 
     def parse_modifiers(self, stream: TokenStream) -> dict:
         modifier_contents = {}
-        with stream.syntax(
-            text=None,
-            comma=r",",
-            pattern=r"@\w+",
-        ):
-            (
-                kw_json,
-                kw_scope,
-                kw_string,
-                kw_integer,
-                kw_bool,
-                kw_link,
-                url,
-                kw_color,
-                hex_code,
-                color,
-                pattern,
-            ) = stream.expect(
-                "kw_json",
-                "kw_scope",
-                "kw_string",
-                "kw_integer",
-                "kw_bool",
-                "kw_link",
-                "url",
-                "kw_color",
-                "hex_code",
-                "color",
-                "pattern",
-            )
-            if kw_json:
-                self.error_if_scope(stream)
-                stream.expect("equals")
-                json = parse_json(stream)
-                if kw_json.value == "hover_item":
-                    modifier_contents["hoverEvent"] = {
-                        "action": "show_item",
-                        "contents": json,
-                    }
-                else:
-                    # Just "with" for now
-                    modifier_contents[kw_json.value] = json
-
-            elif kw_scope:  # Just "hover_text" for now
-                self.error_if_scope(stream)
-                stream.expect("equals")
-                stream.expect(("scope", "<"))
-                with stream.provide(scoped=True):
-                    # Remove the existing parent for a bit
-                    q = self.parent
-                    self.parent = ""
-                    modifier_contents["hoverEvent"] = {
-                        "action": "show_text",
-                        "contents": self.internal_parse(stream),
-                    }
-                    # Put the old parent back (even though we shouldn't need it for this parse)
-                    self.parent = q
-                stream.expect(("scope", ">"))
-
-            elif kw_color or hex_code:
-                if kw_color:
-                    stream.expect("equals")
-                    color, hex_code = stream.expect("color", "hex_code")
-                    color = color.value if color else hex_code.value
-                else:
-                    color = hex_code.value
-
-                modifier_contents["color"] = color
-
-            elif color:
-                modifier_contents["color"] = color.value
-
-            elif url or kw_link:
-                self.error_if_scope(stream)
-                if url:
-                    link = url.value
-                elif kw_link:
-                    stream.expect("equals")
-                    link = self.get_string(stream)
-                    if not link.startswith("http"):
-                        link = f"https://{link}"
-                modifier_contents["clickEvent"] = {"action": "open_url", "value": link}
-
-            elif kw_string:
-                # r"copy|suggest|run|insertion|font",
-                if kw_string.value != "font":
-                    self.error_if_scope(stream)
-                stream.expect("equals")
-                string_value = self.get_string(stream)
-                if kw_string.value == "copy":
-                    modifier_contents["clickEvent"] = {
-                        "action": "copy_to_clipboard",
-                        "value": string_value,
-                    }
-                elif kw_string.value == "suggest":
-                    modifier_contents["clickEvent"] = {
-                        "action": "suggest_command",
-                        "value": string_value,
-                    }
-                elif kw_string.value == "run":
-                    modifier_contents["clickEvent"] = {
-                        "action": "run_command",
-                        "value": string_value,
-                    }
-                elif kw_string.value in {"insertion", "font"}:
-                    modifier_contents[kw_string.value] = string_value
-
-            elif kw_integer:
-                # Just page for now
-                self.error_if_scope(stream)
-                stream.expect("equals")
-                integer_value = stream.expect("integer")
-                modifier_contents["clickEvent"] = {
-                    "action": "change_page",
-                    "value": integer_value.value,
-                }
-
-            elif kw_bool:
-                if stream.get("equals"):
-                    boolean_value = stream.expect("boolean").value
-                else:
-                    boolean_value = "true"
+        with stream.syntax(**MODIFIER_SYNTAX):
+            while True:
+                self.parse_modifier(stream, modifier_contents)
+                if not stream.get("comma"):
+                    break
 
-                modifier_contents[kw_bool.value] = boolean_value == "true"
+        return modifier_contents
 
-            elif pattern:
-                if (q := pattern.value) not in self.patterns:
-                    raise InvalidSyntax(f"Unknown pattern '{q}'")
+    def parse_modifier(self, stream: TokenStream, modifier_contents: dict) -> None:
+        # Parses a single modifier into modifier_contents
+        token = stream.expect()
+        parse_modifier = self.MODIFIERS.get(self.keyword_type(token))
 
-                modifier_contents |= self.patterns[q]
+        if not parse_modifier:
+            raise token.emit_error(UnexpectedToken(token, tuple(self.MODIFIERS)))
 
-            if stream.get("comma"):
-                modifier_contents |= self.parse_modifiers(stream)
+        parse_modifier(self, stream, token, modifier_contents)
 
-        return modifier_contents
+    def parse_json_modifier(
+        self, stream: TokenStream, kw_json: Token, modifier_contents: dict
+    ) -> None:
+        self.error_if_scope(stream)
+        stream.expect("equals")
+        json_value = parse_json(stream)
+        if kw_json.value == "hover_item":
+            modifier_contents["hoverEvent"] = {
+                "action": "show_item",
+                "contents": json_value,
+            }
+        else:
+            # Just "with" for now
+            modifier_contents[kw_json.value] = json_value
+
+    def parse_scope_modifier(
+        self, stream: TokenStream, kw_scope: Token, modifier_contents: dict
+    ) -> None:
+        # Just "hover_text" for now
+        self.error_if_scope(stream)
+        stream.expect("equals")
+        stream.expect(("scope", "<"))
+        with self.enter_scope():
+            # Remove the existing parent for a bit
+            q = self.parent
+            self.parent = ""
+            modifier_contents["hoverEvent"] = {
+                "action": "show_text",
+                "contents": self.internal_parse(stream),
+            }
+            # Put the old parent back (even though we shouldn't need it for this parse)
+            self.parent = q
+        stream.expect(("scope", ">"))
+
+    def parse_string_modifier(
+        self, stream: TokenStream, kw_string: Token, modifier_contents: dict
+    ) -> None:
+        # r"copy|suggest|run|insertion|font",
+        if kw_string.value != "font":
+            self.error_if_scope(stream)
+        stream.expect("equals")
+        string_value = self.get_string(stream)
+        if action := CLICK_ACTIONS.get(kw_string.value):
+            modifier_contents["clickEvent"] = {
+                "action": action,
+                "value": string_value,
+            }
+        else:
+            # Just "insertion" and "font" for now
+            modifier_contents[kw_string.value] = string_value
+
+    def parse_integer_modifier(
+        self, stream: TokenStream, kw_integer: Token, modifier_contents: dict
+    ) -> None:
+        # Just page for now
+        self.error_if_scope(stream)
+        stream.expect("equals")
+        integer_value = stream.expect("integer")
+        modifier_contents["clickEvent"] = {
+            "action": "change_page",
+            "value": integer_value.value,
+        }
+
+    def parse_bool_modifier(
+        self, stream: TokenStream, kw_bool: Token, modifier_contents: dict
+    ) -> None:
+        modifier_contents[kw_bool.value] = self.parse_boolean_argument(stream)
 
-    def clean_ast(self, ast: list) -> list:
-        # Merges strings together into one string
-        cleaned_ast = ast[:1]
-        for elem in ast[1:]:
-            if isinstance(elem, str) and isinstance(cleaned_ast[-1], str):
-                cleaned_ast[-1] += elem
-            else:
-                cleaned_ast.append(elem)
+    def parse_link_modifier(
+        self, stream: TokenStream, kw_link: Token, modifier_contents: dict
+    ) -> None:
+        self.error_if_scope(stream)
+        stream.expect("equals")
+        link = self.get_string(stream)
+        if not link.startswith("http"):
+            link = f"https://{link}"
+        modifier_contents["clickEvent"] = {"action": "open_url", "value": link}
+
+    def parse_url_modifier(
+        self, stream: TokenStream, url: Token, modifier_contents: dict
+    ) -> None:
+        self.error_if_scope(stream)
+        modifier_contents["clickEvent"] = {"action": "open_url", "value": url.value}
 
-        return cleaned_ast
+    def parse_color_modifier(
+        self, stream: TokenStream, kw_color: Token, modifier_contents: dict
+    ) -> None:
+        stream.expect("equals")
+        color, hex_code = self.expect_keyword(stream, "color", "hex_code")
+        modifier_contents["color"] = color.value if color else hex_code.value
 
-    def convert_ast_to_json(self, ast: list) -> list:
-        output = [self.parent or ""]
-        for item in ast:
-            if isinstance(item, str):
-                output.append({"text": item})
-            elif isinstance(item, dict):
-                # Check if it's a modified block
-                if "modifier_contents" in item:
-                    if "modified_text" in item:
-                        new_block = {"text": item["modified_text"][1]["text"]}
-                    else:
-                        # Standalone block
-                        new_block = item["standalone_contents"]
-                    output.append(new_block | item["modifier_contents"])
-                # Otherwise it's a standalone
-                else:
-                    output.append(item)
-            elif isinstance(item, list):
-                output.append(item)
+    def parse_color_value_modifier(
+        self, stream: TokenStream, color: Token, modifier_contents: dict
+    ) -> None:
+        # Both named colors and hex codes can be used on their own
+        modifier_contents["color"] = color.value
 
-        return output
+    def parse_pattern_modifier(
+        self, stream: TokenStream, pattern: Token, modifier_contents: dict
+    ) -> None:
+        if (q := pattern.value) not in self.patterns:
+            raise InvalidSyntax(f"Unknown pattern '{q}'")
+
+        self.uses_definitions = True
+        modifier_contents.update(self.patterns[q])
+
+    # Modifier token type -> modifier parser
+    MODIFIERS = {
+        "kw_json": parse_json_modifier,
+        "kw_scope": parse_scope_modifier,
+        "kw_string": parse_string_modifier,
+        "kw_integer": parse_integer_modifier,
+        "kw_bool": parse_bool_modifier,
+        "kw_link": parse_link_modifier,
+        "url": parse_url_modifier,
+        "kw_color": parse_color_modifier,
+        "hex_code": parse_color_value_modifier,
+        "color": parse_color_value_modifier,
+        "pattern": parse_pattern_modifier,
+    }
@@ -1,4 +1,3 @@
-import json
 from typing import Union, cast
 
 from beet import Context
@@ -19,22 +18,23 @@ class AllayMessage(TextFile, NamespaceFile):
     extension = ".allay"
 
     def bind(self, pack: DataPack, path: str):
-        json = parser.parse(self.text)
-        pack[path] = Message(json)
+        # beet already read the file, so the text is never a path. Message takes the component as is, so there's no need to dump it to a string and load it back.
+        component = parser.parse_string(self.text, json_dump=False)
+        pack[path] = Message(component)
 
         raise Drop()
 
 
 def register_pattern(name: str, raw: Union[JsonDict, str]):
     if isinstance(raw, str):
-        raw = json.loads(parser.parse(f"@{name} = {raw}\n#ALLAYDEFS\n"))
+        parser.parse_string(f"@{name} = {raw}\n#ALLAYDEFS\n", json_dump=False)
     else:
         parser.patterns[f"@{name}"] = raw
 
 
 def register_template(name: str, raw: Union[JsonDict, str]):
     if isinstance(raw, str):
-        raw = json.loads(parser.parse(raw))
+        raw = parser.parse_string(raw, json_dump=False)
 
     parser.templates[f"${name}"] = raw
 
@@ -0,0 +1,8 @@
+import allay
+import pytest
+
+
+@pytest.fixture
+def parser():
+    # Function scoped, since tests add definitions and parents to their parser
+    return allay.Parser()
@@ -1,21 +1,30 @@
+import copy
+import json
+import pathlib
+
 import allay
 import pytest
 from allay.parser import DefinitionAlreadyExists
 from tokenstream.error import InvalidSyntax
 
+FILE_ALLAY = pathlib.Path(__file__).parent / "file.allay"
 
-def test_base_text():
-    parser = allay.Parser()
 
+def test_base_text(parser):
     assert parser.parse("Hello, World", json_dump=False) == [
         "",
         {"text": "Hello, World"},
     ]
 
+    # Text right after a modified block starting with an equals sign
+    assert parser.parse("[x](bold)=5", json_dump=False) == [
+        "",
+        {"text": "x", "bold": True},
+        {"text": "=5"},
+    ]
 
-def test_escaping():
-    parser = allay.Parser()
 
+def test_escaping(parser):
     assert parser.parse(
         'help:=(walrus operator????)pls"work"beans(test=text)w\\~\\~hich\\~\\~_isWHY!you\\\'re-\\[triggered\\].',
         json_dump=False,
@@ -41,18 +50,56 @@ def test_escaping():
     )
 
 
-def test_modifier_json_dumping():
-    parser = allay.Parser()
+def test_modifier_json_dumping(parser):
+    assert json.loads(
+        parser.parse("[All](bold, italic, underlined, strikethrough)")
+    ) == [
+        "",
+        {
+            "text": "All",
+            "bold": True,
+            "italic": True,
+            "underlined": True,
+            "strikethrough": True,
+        },
+    ]
 
     assert (
-        parser.parse("[All](bold, italic, underlined, strikethrough)")
-        == '["", {"text": "All", "bold": true, "italic": true, "underlined": true, "strikethrough": true}]'
+        parser.parse("[All](bold)", indent=0)
+        == '[\n"",\n{\n"text": "All",\n"bold": true\n}\n]'
     )
 
+    # Cached results are keyed on the indent too
+    assert parser.parse("[All](bold)") == '["", {"text": "All", "bold": true}]'
+    assert parser.parse("[All](bold)") == '["", {"text": "All", "bold": true}]'
 
-def test_modifier_booleans():
-    parser = allay.Parser()
 
+def test_cache():
+    parser = allay.Parser(cache_size=2)
+
+    # Repeated text is served from the cache
+    first = parser.parse("[A](bold)")
+    assert parser.cache == {("[A](bold)", None): first}
+    assert parser.parse("[A](bold)") is first
+
+    # The oldest entry is dropped once the cache is full
+    parser.parse("B")
+    parser.parse("C")
+    assert list(parser.cache) == [("B", None), ("C", None)]
+
+    # Output that uses a definition isn't cached, since definitions can be replaced directly
+    parser.patterns["@x"] = {"bold": True}
+    assert parser.parse("[A](@x)") == '["", {"text": "A", "bold": true}]'
+    parser.patterns["@x"] = {"italic": True}
+    assert parser.parse("[A](@x)") == '["", {"text": "A", "italic": true}]'
+    assert list(parser.cache) == [("B", None), ("C", None)]
+
+    parser = allay.Parser(cache_size=0)
+    parser.parse("[A](bold)")
+    assert parser.cache == {}
+
+
+def test_modifier_booleans(parser):
     assert parser.parse(
         "[All](bold, italic, underlined, strikethrough, obfuscated)", json_dump=False
     ) == [
@@ -80,18 +127,14 @@ def test_modifier_booleans():
     ]
 
 
-def test_modifier_integers():
-    parser = allay.Parser()
-
+def test_modifier_integers(parser):
     assert parser.parse("[All](page=3)", json_dump=False) == [
         "",
         {"text": "All", "clickEvent": {"action": "change_page", "value": "3"}},
     ]
 
 
-def test_modifier_strings():
-    parser = allay.Parser()
-
+def test_modifier_strings(parser):
     assert parser.parse(
         '[All](font="my:font", copy="sus", insertion="I can think of")',
         json_dump=False,
@@ -108,6 +151,10 @@ def test_modifier_strings():
         },
     ]
 
+    assert parser.parse(
+        '[All](insertion="C:\\\\Users \\"quoted\\" \\n")', json_dump=False
+    ) == ["", {"text": "All", "insertion": 'C:\\Users "quoted" \\n'}]
+
     assert parser.parse('[All](suggest="why is amogus")', json_dump=False) == [
         "",
         {
@@ -131,68 +178,25 @@ def test_modifier_strings():
     ]
 
 
-def test_modifier_urls():
-    parser = allay.Parser()
+def open_url(text, url):
+    return ["", {"text": text, "clickEvent": {"action": "open_url", "value": url}}]
 
-    assert parser.parse('[All](link="https://example.com")', json_dump=False) == [
-        "",
-        {
-            "text": "All",
-            "clickEvent": {
-                "action": "open_url",
-                "value": "https://example.com",
-            },
-        },
-    ]
 
-    assert parser.parse('[All](link="http://example.com")', json_dump=False) == [
-        "",
-        {
-            "text": "All",
-            "clickEvent": {
-                "action": "open_url",
-                "value": "http://example.com",
-            },
-        },
-    ]
+@pytest.mark.parametrize(
+    "src,expected",
+    [
+        ('[All](link="https://example.com")', open_url("All", "https://example.com")),
+        ('[All](link="http://example.com")', open_url("All", "http://example.com")),
+        ('[All](link="example.com")', open_url("All", "https://example.com")),
+        ("[All](https://example.com)", open_url("All", "https://example.com")),
+        ("[All](http://example.com)", open_url("All", "http://example.com")),
+    ],
+)
+def test_modifier_urls(parser, src, expected):
+    assert parser.parse(src, json_dump=False) == expected
 
-    assert parser.parse('[All](link="example.com")', json_dump=False) == [
-        "",
-        {
-            "text": "All",
-            "clickEvent": {
-                "action": "open_url",
-                "value": "https://example.com",
-            },
-        },
-    ]
-
-    assert parser.parse("[All](https://example.com)", json_dump=False) == [
-        "",
-        {
-            "text": "All",
-            "clickEvent": {
-                "action": "open_url",
-                "value": "https://example.com",
-            },
-        },
-    ]
-
-    assert parser.parse("[All](http://example.com)", json_dump=False) == [
-        "",
-        {
-            "text": "All",
-            "clickEvent": {
-                "action": "open_url",
-                "value": "http://example.com",
-            },
-        },
-    ]
-
-
-def test_modifier_scope_blocks():
-    parser = allay.Parser()
 
+def test_modifier_scope_blocks(parser):
     assert parser.parse("[All](hover_text=<Hello, World!>)", json_dump=False) == [
         "",
         {
@@ -221,9 +225,7 @@ def test_modifier_scope_blocks():
     ]
 
 
-def test_modifier_json():
-    parser = allay.Parser()
-
+def test_modifier_json(parser):
     assert parser.parse(
         '[All](hover_item={"id": "minecraft:netherite_hoe", "tag": "{display: {Name: \\"\\\\\\"joe\\\\\\"\\"}}"})',
         json_dump=False,
@@ -241,34 +243,36 @@ def test_modifier_json():
         },
     ]
 
-
-def test_modifier_color():
-    parser = allay.Parser()
-
-    assert parser.parse("[Some](color=blue)", json_dump=False) == [
-        "",
-        {"text": "Some", "color": "blue"},
-    ]
-
-    assert parser.parse("[Some](blue)", json_dump=False) == [
-        "",
-        {"text": "Some", "color": "blue"},
-    ]
-
-    assert parser.parse("[Some](#47cdff)", json_dump=False) == [
+    # Falls back to token by token parsing for the trailing comma, which accepts the same numbers
+    assert parser.parse(
+        '[All](hover_item={"id": "minecraft:stone", "count": -1, "a": 1.5e2,})',
+        json_dump=False,
+    ) == [
         "",
-        {"text": "Some", "color": "#47cdff"},
+        {
+            "text": "All",
+            "hoverEvent": {
+                "action": "show_item",
+                "contents": {"id": "minecraft:stone", "count": -1, "a": 150.0},
+            },
+        },
     ]
 
-    assert parser.parse("[Some](color=#47cdff)", json_dump=False) == [
-        "",
-        {"text": "Some", "color": "#47cdff"},
-    ]
 
+@pytest.mark.parametrize(
+    "src,expected",
+    [
+        ("[Some](color=blue)", ["", {"text": "Some", "color": "blue"}]),
+        ("[Some](blue)", ["", {"text": "Some", "color": "blue"}]),
+        ("[Some](#47cdff)", ["", {"text": "Some", "color": "#47cdff"}]),
+        ("[Some](color=#47cdff)", ["", {"text": "Some", "color": "#47cdff"}]),
+    ],
+)
+def test_modifier_color(parser, src, expected):
+    assert parser.parse(src, json_dump=False) == expected
 
-def test_standalone():
-    parser = allay.Parser()
 
+def test_standalone(parser):
     assert parser.parse(
         '{@s, translate="translation:key", with=["some", "json"], sep=" - ", key=advancements}',
         json_dump=False,
@@ -313,20 +317,43 @@ def test_standalone():
         {"nbt": "key", "storage": "in_our_midst", "interpret": True},
     ]
 
+    assert parser.parse('{@e[type=cow], sep="]"}', json_dump=False) == [
+        "",
+        {"selector": "@e[type=cow]", "separator": "]"},
+    ]
+
+    assert parser.parse('{@e[name="a]b"]}', json_dump=False) == [
+        "",
+        {"selector": '@e[name="a]b"]'},
+    ]
+
+    # Deeper than the selector rule matches, found by scanning for the closing bracket
+    assert parser.parse(
+        '{@e[nbt={Items:[{tag:{x:[1]}}]}], sep="]"}', json_dump=False
+    ) == [
+        "",
+        {"selector": "@e[nbt={Items:[{tag:{x:[1]}}]}]", "separator": "]"},
+    ]
+
     assert parser.parse("{@s}(bold)", json_dump=False) == [
         "",
         {"selector": "@s", "bold": True},
     ]
 
 
-def test_definitions():
-    parser = allay.Parser()
-
+def test_definitions(parser):
     parser.add_pattern("extern_patt1", "(bold, italic, blue)")
     parser.add_pattern("extern_patt2", "(bold=false, obfuscated, blue)")
     parser.add_template("extern_temp1", "arg 1: %0\\\\narg 2: %1")
     parser.add_template("extern_temp2", "Go away, %0")
 
+    # Definitions are stored as plain data, so the parser can still be copied and dumped
+    assert json.loads(json.dumps(parser.patterns)) == {
+        "@extern_patt1": {"bold": True, "italic": True, "color": "blue"},
+        "@extern_patt2": {"bold": False, "obfuscated": True, "color": "blue"},
+    }
+    copy.deepcopy(parser)
+
     assert parser.parse("[Many](@extern_patt1)", json_dump=False) == [
         "",
         {"text": "Many", "bold": True, "italic": True, "color": "blue"},
@@ -367,6 +394,17 @@ def test_definitions():
         ["", {"text": "Go away, %0"}],
     ]
 
+    assert parser.parse('{$extern_temp2, "\\"Felix\\""}', json_dump=False) == [
+        "",
+        ["", {"text": 'Go away, "Felix"'}],
+    ]
+
+    # Arguments decode JSON escapes
+    assert parser.parse('{$extern_temp2, "Fe\\nlix\\t\\u00e9"}', json_dump=False) == [
+        "",
+        ["", {"text": "Go away, Fe\nlix\t\u00e9"}],
+    ]
+
     parser.set_parent("(bold, blue)")
     assert parser.parse("Somebody", json_dump=False) == [
         {"bold": True, "color": "blue"},
@@ -383,6 +421,32 @@ def test_definitions():
         ["", {"text": "ABC"}],
     ]
 
+    # The same definitions can be parsed again, only the text after them changed here
+    assert parser.parse(
+        "@intern_patt = (yellow)\n$intern_temp = {ABC}\nPARENT = (green, underlined)\n#ALLAYDEFS\n[Again](@intern_patt)",
+        json_dump=False,
+    ) == [
+        {"color": "green", "underlined": True},
+        {"text": "Again", "color": "yellow"},
+    ]
+
+    # Reused definitions only restore a parent the block sets itself, not one from set_parent
+    parser = allay.Parser()
+    parser.set_parent("(italic)")
+    assert parser.parse("@p = (red)\n#ALLAYDEFS\n[A](@p)", json_dump=False) == [
+        {"italic": True},
+        {"text": "A", "color": "red"},
+    ]
+    assert parser.parse("@p = (red)\n#ALLAYDEFS\n[A](@p)", json_dump=False) == [
+        "",
+        {"text": "A", "color": "red"},
+    ]
+    parser.set_parent("(italic)")
+    assert parser.parse("@p = (red)\n#ALLAYDEFS\n[A](@p)", json_dump=False) == [
+        {"italic": True},
+        {"text": "A", "color": "red"},
+    ]
+
     # You can even set the parent of templates by doing this (yes this in intended):
     parser = allay.Parser()
     parser.set_parent("(italic)")
@@ -421,13 +485,7 @@ def test_definitions():
 
 
 def test_file_io():
-    import os
-
-    parser = allay.Parser()
-
-    assert parser.parse(
-        os.path.join(os.getcwd(), "tests", "file.allay"), json_dump=False
-    ) == [
+    expected = [
         "",
         {"text": "Doobah Dabba Dee\n"},
         ["", {"text": "Never gonna give you up\nNever gonna let you down"}],
@@ -435,78 +493,73 @@ def test_file_io():
         {"text": "A Few", "bold": True, "color": "blue"},
     ]
 
-    parser = allay.Parser()
+    # Each way of loading the file gets a fresh parser, so none of them rely on definitions left by another
+    assert allay.Parser().parse(str(FILE_ALLAY), json_dump=False) == expected
+    assert allay.Parser().parse_file(str(FILE_ALLAY), json_dump=False) == expected
+    assert allay.Parser().parse(FILE_ALLAY.read_text(), json_dump=False) == expected
 
-    with open(os.path.join(os.getcwd(), "tests", "file.allay"), "r") as infile:
-        assert parser.parse(infile.read(), json_dump=False) == [
-            "",
-            {"text": "Doobah Dabba Dee\n"},
-            ["", {"text": "Never gonna give you up\nNever gonna let you down"}],
-            {"text": "\n"},
-            {"text": "A Few", "bold": True, "color": "blue"},
-        ]
+    # parse_string never treats its input as a path
+    assert allay.Parser().parse_string(str(FILE_ALLAY), json_dump=False) == [
+        "",
+        {"text": str(FILE_ALLAY)},
+    ]
 
 
 def test_parser_defaults():
     parser = allay.Parser(json_dump=False)
 
     # Do the check twice to be sure it persists
-    assert isinstance(parser.parse("Hello"), list)
-    assert isinstance(parser.parse("World!"), list)
+    assert type(parser.parse("Hello")) is list
+    assert type(parser.parse("World!")) is list
 
     parser.set_defaults(json_dump=True)
 
-    assert isinstance(parser.parse("Hello"), str)
-    assert isinstance(parser.parse("World!"), str)
+    assert type(parser.parse("Hello")) is str
+    assert type(parser.parse("World!")) is str
 
     # Reset defaults
     parser = allay.Parser()
-    assert isinstance(parser.parse("Hello"), str)
-
-
-def test_syntax_errors():
-    parser = allay.Parser()
-
-    with pytest.raises(InvalidSyntax):
-        parser.parse("[Hello](bold, italic, blue")
-
-    with pytest.raises(InvalidSyntax):
-        parser.parse("[Hello(bold, italic, blue)")
-
+    assert type(parser.parse("Hello")) is str
+
+
+@pytest.mark.parametrize(
+    "src",
+    [
+        "[Hello](bold, italic, blue",
+        "[Hello(bold, italic, blue)",
+        "[Hello]",
+        "[Hello\\]",
+        'Python f-strings: f"{query}"',
+        "[Hello](@World)",
+        "{$missingno}",
+        "[Hello](what)",
+        '[Hello](hover_item={"a": NaN})',
+        "{dooba_dooba_doo_doo_doo_doo__aaaaaah}",
+        "[" * 1000 + "Too deep" + "](bold)" * 1000,
+        "[A](hover_item=" + "[" * 3000 + "]" * 3000 + ")",
+        '[A](hover_item={"a": ' + "[" * 3000 + "]" * 3000 + ",})",
+        "@broken_pattern = (nope)\n#ALLAYDEFS\nText",
+        "[A bit of a niche one](hover_text=<But we gotta check [these](page=12)>)",
+        '[A bit of a niche one](hover_text=<But we gotta check [these](run="Explain to me how you\'re gonna have the user click a HOVER event")>)',
+    ],
+)
+def test_syntax_errors(parser, src):
     with pytest.raises(InvalidSyntax):
-        parser.parse("[Hello]")
+        parser.parse(src)
 
-    with pytest.raises(InvalidSyntax):
-        parser.parse("[Hello\\]")
-
-    with pytest.raises(InvalidSyntax):
-        parser.parse('Python f-strings: f"{query}"')
 
+def test_stateful_syntax_errors(parser):
     with pytest.raises(InvalidSyntax):
         parser.add_template("temporary_temp", "can't style this bum bum bum bum")
         parser.parse("{$temporary_temp}(bold)")
 
     with pytest.raises(InvalidSyntax):
-        parser.parse("[Hello](@World)")
+        parser.parse('{$temporary_temp, "Invalid \\q escape"}')
 
+    # A failed parse doesn't leave its parent behind
     with pytest.raises(InvalidSyntax):
-        parser.parse("{$missingno}")
-
-    with pytest.raises(InvalidSyntax):
-        parser.parse("[Hello](what)")
-
-    with pytest.raises(InvalidSyntax):
-        parser.parse("{dooba_dooba_doo_doo_doo_doo__aaaaaah}")
-
-    with pytest.raises(InvalidSyntax):
-        parser.parse(
-            "[A bit of a niche one](hover_text=<But we gotta check [these](page=12)>)"
-        )
-
-    with pytest.raises(InvalidSyntax):
-        parser.parse(
-            '[A bit of a niche one](hover_text=<But we gotta check [these](run="Explain to me how you\'re gonna have the user click a HOVER event")>)'
-        )
+        parser.parse("PARENT = (bold)\n#ALLAYDEFS\n[Broken")
+    assert parser.parse("Text", json_dump=False) == ["", {"text": "Text"}]
 
 
 def test_definition_errors():